@@ -2,19 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import emoji
+import datetime
+import multiprocessing
+import os
 import sys
 import time
 import logging
 import yaml
+import zlib
 from functools import wraps
 from os import path
-from pytz import timezone
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
 from telegram.ext.dispatcher import run_async
-from telegram import ChatAction
+from telegram import ChatAction, InlineKeyboardButton, InlineKeyboardMarkup
 from threading import Thread
-from vmware_task_telegram_bot.db import DB
+from vmware_task_telegram_bot.cache import SnapshotCache
+from vmware_task_telegram_bot.db import DB, OUTBOX_DELIVERED, OUTBOX_FAILED
+from vmware_task_telegram_bot.export import ExportException, ExportTooLarge, apply_filters, export, parse_filters
+from vmware_task_telegram_bot.model import AlarmSnapshot, TaskSnapshot, render_alarm, render_task
+from vmware_task_telegram_bot.rules import RuleIndex
 from vmware_task_telegram_bot.vmware import vCenter
 
 
@@ -22,9 +28,17 @@ cfg = None
 vc = None
 db = None
 sender = None
+snapshots = None
+rules = None
+task_watermark = None
+seen_tasks = set()
+tz = None
 updater = None
 logger = None
 
+MAX_PAGE_LENGTH = 4000
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
 
 def get_config(path):
     try:
@@ -74,13 +88,59 @@ def restricted(func):
         user_id = update.effective_user.id
 
         if user_id not in cfg['telegram']['allow_user']:
-            context.bot.sendMessage(chat_id=update.message.chat_id,
+            context.bot.sendMessage(chat_id=update.effective_chat.id,
                                     text=u'Ой! Вы не авторизованы для этого типа запросов.')
             return
         return func(update, context, *args, **kwargs)
     return wrapped
 
 
+def paginate(responses, page_size):
+    pages = []
+    page = []
+    length = 0
+    for response in responses:
+        if page and (len(page) >= page_size or length + len(response) > MAX_PAGE_LENGTH):
+            pages.append(page)
+            page = []
+            length = 0
+        page.append(response)
+        length += len(response) + 2
+    if page:
+        pages.append(page)
+    if len(pages) == 1:
+        return [u'\r\n'.join(pages[0])]
+    return [u'\r\n'.join(page) + u'\r\nСтраница {} из {}'.format(number + 1, len(pages))
+            for number, page in enumerate(pages)]
+
+
+def page_keyboard(page, total):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(u'« Назад', callback_data='page:{}'.format(page - 1)))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton(u'Вперед »', callback_data='page:{}'.format(page + 1)))
+    return InlineKeyboardMarkup([buttons])
+
+
+def send_paginated(update, context, responses):
+    pages = paginate(responses, cfg.get('pagination', {}).get('page_size', 10))
+    if len(pages) == 1:
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=pages[0])
+        return
+    if not snapshots.fits(pages):
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=pages[0])
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Результат слишком большой для постраничного просмотра, показана только первая страница. Используйте /vmexport для выгрузки полного списка.')
+        return
+    message = context.bot.sendMessage(chat_id=update.message.chat_id,
+                                      text=pages[0],
+                                      reply_markup=page_keyboard(0, len(pages)))
+    snapshots.put(message.chat_id, message.message_id, pages)
+
+
 @run_async
 def error(update, exc):
     global logger
@@ -121,16 +181,14 @@ def list_running_task(update, context):
                                 text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
     else:
         if tasks:
-            for task in tasks:
-                try:
-                    response = u'ID: {}\r\nОписание: {}\r\nОбъект: {}\r\nПользователь: {}\r\nСтатус: {}\r\nПроцент выполнения: {}\r\nНачало работы: {}\r\n'.format(task['eventChainId'], task['descriptionId'], task['entityName'], task['username'], task['state'], task['progress'], task['startTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'))
-                except Exception as exc:
-                    error(update, exc)
-                    context.bot.sendMessage(chat_id=update.message.chat_id,
-                                            text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
-
+            try:
+                responses = [render_task(task, 'running', tz) for task in tasks]
+            except Exception as exc:
+                error(update, exc)
                 context.bot.sendMessage(chat_id=update.message.chat_id,
-                                        text=response)
+                                        text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+            else:
+                send_paginated(update, context, responses)
         else:
             context.bot.sendMessage(chat_id=update.message.chat_id,
                                     text=u'Активных задач нет.')
@@ -139,10 +197,6 @@ def list_running_task(update, context):
 @run_async
 @restricted
 def list_active_alarm(update, context):
-    alarm_status_emoji = {'gray': emoji.emojize(':gray_circle:'),
-                          'green': emoji.emojize(':green_circle:'),
-                          'yellow': emoji.emojize(':yellow_circle:'),
-                          'red': emoji.emojize(':red_circle:')}
     context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
     try:
         global vc
@@ -153,24 +207,39 @@ def list_active_alarm(update, context):
                                 text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
     else:
         if alarms:
-            for alarm in sorted(alarms, key=lambda i: i['time'], reverse=True):
-                try:
-                    response = u'Описание: {}\r\nОбъект: {}\r\nВажность: {}\r\nВремя: {}\r\n'.format(alarm['description'],
-                                                                                                     alarm['entityName'],
-                                                                                                     alarm_status_emoji[alarm['status']],
-                                                                                                     alarm['time'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'))
-                except Exception as exc:
-                    error(update, exc)
-                    context.bot.sendMessage(chat_id=update.message.chat_id,
-                                            text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
-
+            try:
+                responses = [render_alarm(alarm, tz)
+                             for alarm in sorted(alarms, key=lambda i: i.time, reverse=True)]
+            except Exception as exc:
+                error(update, exc)
                 context.bot.sendMessage(chat_id=update.message.chat_id,
-                                        text=response)
+                                        text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+            else:
+                send_paginated(update, context, responses)
         else:
             context.bot.sendMessage(chat_id=update.message.chat_id,
                                     text=u'Активных триггеров нет.')
 
 
+@run_async
+@restricted
+def turn_page(update, context):
+    query = update.callback_query
+    page = int(query.data.split(':')[1])
+    pages = snapshots.get(query.message.chat_id, query.message.message_id)
+    if pages is None or page >= len(pages):
+        query.answer(text=u'Результаты устарели. Повторите запрос.')
+        return
+    try:
+        context.bot.editMessageText(chat_id=query.message.chat_id,
+                                    message_id=query.message.message_id,
+                                    text=pages[page],
+                                    reply_markup=page_keyboard(page, len(pages)))
+    except Exception as exc:
+        error(update, exc)
+    query.answer()
+
+
 @run_async
 @restricted
 def subscribe_all_task(update, context):
@@ -182,6 +251,8 @@ def subscribe_all_task(update, context):
 @restricted
 def subscribe_task(update, context):
     context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
+    if context.args and context.args[0].isdigit():
+        context.args[0] = normalize_task_id(context.args[0])
     try:
         global vc
         if context.args[0] == 'all':
@@ -205,11 +276,11 @@ def subscribe_task(update, context):
                     if context.args[0] == 'all':
                         new_subscription_flag = False
                         for task in tasks:
-                            if not db.get_subsciption(update.message.chat_id, task['eventChainId']):
+                            if not db.get_subsciption(update.message.chat_id, task.eventChainId):
                                 new_subscription_flag = True
-                                db.add_subscription(update.message.chat_id, task['eventChainId'])
+                                db.add_subscription(update.message.chat_id, task.eventChainId)
                                 context.bot.sendMessage(chat_id=update.message.chat_id,
-                                                        text=u'Вы подписаны на оповещения об окончании задачи {}.'.format(task['eventChainId']))
+                                                        text=u'Вы подписаны на оповещения об окончании задачи {}.'.format(task.eventChainId))
                         if not new_subscription_flag:
                             context.bot.sendMessage(chat_id=update.message.chat_id,
                                                     text=u'Вы уже подписаны на оповещения об окончании всех текущих активных задач.')
@@ -239,6 +310,8 @@ def unsubscribe_all_task(update, context):
 @restricted
 def unsubscribe_task(update, context):
     context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
+    if context.args and context.args[0].isdigit():
+        context.args[0] = normalize_task_id(context.args[0])
     try:
         global vc
         if context.args[0] == 'all':
@@ -306,7 +379,7 @@ def list_subscription(update, context):
                         task = vc.get_task(subscription[1])
                         task = task[0]
                         try:
-                            response = u'ID: {}\r\nОписание: {}\r\nОбъект: {}\r\nПользователь: {}\r\nСтатус: {}\r\nПрогресс выполнения: {} %\r\nНачало работы: {}\r\n'.format(task['eventChainId'], task['descriptionId'], task['entityName'], task['username'], task['state'], task['progress'], task['startTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'))
+                            response = render_task(task, 'subscription', tz)
                         except Exception as exc:
                             error(update, exc)
                             context.bot.sendMessage(chat_id=update.message.chat_id,
@@ -323,46 +396,354 @@ def list_subscription(update, context):
                                         text=u'У вас нет активных подписок.')
 
 
-def check_subscriptions():
+@run_async
+@restricted
+def subscribe_rule(update, context):
+    context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
+    if len(context.args) != 2 or not RuleIndex.validate(context.args[0], context.args[1]):
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Использование: /vmsubrule entity|user|type шаблон. Символ * допускается только в конце имени объекта.')
+        return
+    field, pattern = context.args
+    try:
+        db = DB(cfg['db']['path'])
+    except Exception as exc:
+        logger.error('SQLite DB connection error: {}'.format(exc))
+    else:
+        try:
+            if db.get_rule(update.message.chat_id, field, pattern):
+                context.bot.sendMessage(chat_id=update.message.chat_id,
+                                        text=u'Вы уже подписаны на задачи по правилу {} {}.'.format(field, pattern))
+            else:
+                db.add_rule(update.message.chat_id, field, pattern)
+                reload_rules(db)
+                context.bot.sendMessage(chat_id=update.message.chat_id,
+                                        text=u'Вы подписаны на оповещения об окончании новых задач по правилу {} {}.'.format(field, pattern))
+        except Exception as exc:
+            error(update, exc)
+            context.bot.sendMessage(chat_id=update.message.chat_id,
+                                    text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+
+
+@run_async
+@restricted
+def unsubscribe_rule(update, context):
+    context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
+    if not (context.args == ['all'] or len(context.args) == 2):
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Использование: /vmunsubrule entity|user|type шаблон или /vmunsubrule all.')
+        return
+    try:
+        db = DB(cfg['db']['path'])
+    except Exception as exc:
+        logger.error('SQLite DB connection error: {}'.format(exc))
+    else:
+        try:
+            if context.args[0] == 'all':
+                if db.get_rule_by_uid(update.message.chat_id):
+                    db.remove_rule_by_uid(update.message.chat_id)
+                    reload_rules(db)
+                    context.bot.sendMessage(chat_id=update.message.chat_id,
+                                            text=u'Все подписки по правилам отменены.')
+                else:
+                    context.bot.sendMessage(chat_id=update.message.chat_id,
+                                            text=u'У вас нет подписок по правилам.')
+            else:
+                field, pattern = context.args
+                if db.get_rule(update.message.chat_id, field, pattern):
+                    db.remove_rule(update.message.chat_id, field, pattern)
+                    reload_rules(db)
+                    context.bot.sendMessage(chat_id=update.message.chat_id,
+                                            text=u'Подписка по правилу {} {} отменена.'.format(field, pattern))
+                else:
+                    context.bot.sendMessage(chat_id=update.message.chat_id,
+                                            text=u'Вы не подписаны на задачи по правилу {} {}.'.format(field, pattern))
+        except Exception as exc:
+            error(update, exc)
+            context.bot.sendMessage(chat_id=update.message.chat_id,
+                                    text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+
+
+@run_async
+@restricted
+def list_rule(update, context):
+    context.bot.sendChatAction(update.message.chat_id, action=ChatAction.TYPING)
+    try:
+        db = DB(cfg['db']['path'])
+    except Exception as exc:
+        logger.error('SQLite DB connection error: {}'.format(exc))
+    else:
+        try:
+            items = db.get_rule_by_uid(update.message.chat_id)
+        except Exception as exc:
+            error(update, exc)
+            context.bot.sendMessage(chat_id=update.message.chat_id,
+                                    text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+        else:
+            if items:
+                context.bot.sendMessage(chat_id=update.message.chat_id,
+                                        text=u'\r\n'.join(u'{} {}'.format(item[1], item[2]) for item in items))
+            else:
+                context.bot.sendMessage(chat_id=update.message.chat_id,
+                                        text=u'У вас нет подписок по правилам.')
+
+
+@run_async
+@restricted
+def export_result(update, context):
+    usage = (u'Использование:\r\n'
+             u'/vmexport tasks [entity=шаблон] [user=шаблон] [type=шаблон] [state=шаблон] [csv|json] [gz]\r\n'
+             u'/vmexport history [entity=шаблон] [user=шаблон] [type=шаблон] [state=шаблон] [days=N] [csv|json] [gz]\r\n'
+             u'/vmexport alarms [entity=шаблон] [status=шаблон] [description=шаблон] [csv|json] [gz]')
+    if not context.args or context.args[0] not in ('tasks', 'alarms', 'history'):
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=usage)
+        return
+    kind = context.args[0]
+    fmt = 'csv'
+    compress = False
+    days = 1
+    filters = []
+    for arg in context.args[1:]:
+        if arg in ('csv', 'json'):
+            fmt = arg
+        elif arg == 'gz':
+            compress = True
+        elif kind == 'history' and arg.startswith('days=') and arg[5:].isdigit():
+            days = int(arg[5:])
+        else:
+            filters.append(arg)
+    try:
+        filters = parse_filters(kind, filters)
+    except ExportException:
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=usage)
+        return
+    settings = cfg.get('export', {})
+    max_days = settings.get('max_days', 31)
+    if days > max_days:
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Можно выгрузить историю не более чем за {} дн.'.format(max_days))
+        return
+
+    context.bot.sendChatAction(update.message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+    try:
+        if kind == 'alarms':
+            items = vc.iter_alarm()
+            fields = AlarmSnapshot.__slots__
+        elif kind == 'tasks':
+            items = vc.iter_task(state='running')
+            fields = TaskSnapshot.__slots__
+        else:
+            begin_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+            items = vc.iter_task(begin_time=begin_time)
+            fields = TaskSnapshot.__slots__
+        document, count = export(apply_filters(items, filters), fields, fmt, compress, tz,
+                                 settings.get('spool_size', 1024 * 1024),
+                                 min(settings.get('max_upload', 20 * 1024 * 1024), MAX_UPLOAD_SIZE))
+    except ExportTooLarge:
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Выгрузка слишком большая для отправки. Уточните фильтры, уменьшите days или добавьте gz.')
+        return
+    except Exception as exc:
+        error(update, exc)
+        context.bot.sendMessage(chat_id=update.message.chat_id,
+                                text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+        return
+
+    with document:
+        if not count:
+            context.bot.sendMessage(chat_id=update.message.chat_id,
+                                    text=u'Нет данных для выгрузки.')
+            return
+        filename = '{}-{}.{}{}'.format(kind,
+                                        datetime.datetime.now().strftime('%Y%m%d-%H%M'),
+                                        fmt,
+                                        '.gz' if compress else '')
+        try:
+            context.bot.sendDocument(chat_id=update.message.chat_id,
+                                     document=document,
+                                     filename=filename)
+        except Exception as exc:
+            error(update, exc)
+            context.bot.sendMessage(chat_id=update.message.chat_id,
+                                    text=u'Ой! Произошла ошибка. Попробуйте еще раз позже.')
+
+
+def reload_rules(db):
+    global rules
+    rules = RuleIndex(db.list_rules())
+
+
+def check_rules():
+    global task_watermark
+    global seen_tasks
+    logger.info('Start subscription rules checking')
+    try:
+        if task_watermark is None:
+            task_watermark = vc.current_time()
+            return
+        tasks = list(vc.iter_task(begin_time=task_watermark,
+                                  page_size=cfg.get('rules', {}).get('page_size', 100),
+                                  time_type='queuedTime'))
+    except Exception as exc:
+        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+        return
+
+    # Tasks queued exactly at the watermark are returned again on the next cycle
+    new_tasks = [task for task in tasks if task.key not in seen_tasks]
+    queued = [task.queueTime for task in tasks if task.queueTime]
+    if queued:
+        task_watermark = max(queued)
+        seen_tasks = set(task.key for task in tasks if task.queueTime == task_watermark)
+    if not new_tasks or rules is None:
+        return
+
+    try:
+        db = DB(cfg['db']['path'])
+    except Exception as exc:
+        logger.error('SQLite DB connection error: {}'.format(exc))
+        return
+
+    for task in new_tasks:
+        uids = rules.match(task)
+        if not uids:
+            continue
+        try:
+            if task.state in ('success', 'error'):
+                response = render_task(task, task.state, tz)
+            else:
+                response = u'Вы подписаны на оповещения об окончании задачи {} ({} {}).'.format(task.eventChainId,
+                                                                                                task.descriptionId,
+                                                                                                task.entityName)
+        except Exception as exc:
+            logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+            continue
+
+        for uid in uids:
+            try:
+                if task.state in ('success', 'error'):
+                    db.add_outbox(uid, '{}:{}:{}'.format(uid, task.eventChainId, task.state), response)
+                elif not db.get_subsciption(uid, task.eventChainId):
+                    db.add_subscription(uid, task.eventChainId)
+                    db.add_outbox(uid, '{}:{}:subscribed'.format(uid, task.eventChainId), response)
+            except Exception as exc:
+                logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+
+
+def normalize_task_id(task_id):
+    return str(int(task_id))
+
+
+def task_shard(task_id, shards):
+    return zlib.crc32(str(task_id).encode('utf-8')) % shards
+
+
+def check_subscriptions(owned=None, shards=None, renew=None):
     logger.info('Start subscriptions checking')
     try:
         db = DB(cfg['db']['path'])
     except Exception as exc:
-        logger.error('%s' % ('{}({})'.format(type(exc).__name__, error)))
+        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
     else:
         try:
             subscriptions = db.list_subscriptions()
         except Exception as exc:
-            logger.error('%s' % ('{}({})'.format(type(exc).__name__, error)))
+            logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
         else:
-            if subscriptions:
-                global vc
-                for subscription in subscriptions:
+            subscribers = {}
+            for uid, raw_id in subscriptions:
+                try:
+                    task_id = normalize_task_id(raw_id)
+                except ValueError:
+                    logger.error('Invalid task id {} in subscription of {}'.format(raw_id, uid))
+                    continue
+                if owned is not None and task_shard(task_id, shards) not in owned:
+                    continue
+                subscribers.setdefault(task_id, []).append((uid, raw_id))
+
+            task_ids = list(subscribers)
+            batch_size = cfg.get('checker', {}).get('batch_size', 100)
+            for offset in range(0, len(task_ids), batch_size):
+                batch = task_ids[offset:offset + batch_size]
+                if renew is not None and offset:
+                    # Keep the leases alive on long cycles and drop shards taken over by other workers
                     try:
-                        task = vc.get_task(subscription[1])
-                        task = task[0]
+                        owned = renew()
                     except Exception as exc:
                         logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
-                    else:
-                        try:
-                            if task['state'] == 'success':
-                                response = u'Задача успешно завершена\r\nID: {}\r\nОписание: {}\r\nОбъект: {}\r\nПользователь: {}\r\nСтатус: {}\r\nНачало работы: {}\r\nОкончание работы: {}'.format(task['eventChainId'], task['descriptionId'], task['entityName'], task['username'], task['state'], task['startTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'), task['completeTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'))
-                                db.remove_subscription(subscription[0], subscription[1])
-                            elif task['state'] == 'error':
-                                response = u'Задача завершена с ошибкой\r\nID: {}\r\nОписание: {}\r\nОбъект: {}\r\nПользователь: {}\r\nСтатус: {}\r\nОписание ошибки: {}\r\nНачало работы: {}\r\nОкончание работы: {}'.format(task['eventChainId'], task['descriptionId'], task['entityName'], task['username'], task['state'], task['error'], task['startTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'), task['completeTime'].astimezone(timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M'))
-                                db.remove_subscription(subscription[0], subscription[1])
-                        except Exception as exc:
-                            logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
-                        else:
-                            if task['state'] == 'success' or task['state'] == 'error':
-                                global updater
-                                try:
-                                    updater.bot.sendMessage(
-                                        chat_id=subscription[0],
-                                        text=response
-                                    )
-                                except Exception as exc:
-                                    logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+                        return
+                    batch = [task_id for task_id in batch if task_shard(task_id, shards) in owned]
+                if not batch:
+                    continue
+                tasks = {}
+                try:
+                    for task in vc.iter_task(ids=batch):
+                        tasks.setdefault(str(task.eventChainId), task)
+                except Exception as exc:
+                    logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+                    continue
+
+                for task_id in batch:
+                    task = tasks.get(task_id)
+                    if task is None or task.state not in ('success', 'error'):
+                        continue
+                    try:
+                        response = render_task(task, task.state, tz)
+                    except Exception as exc:
+                        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+                        continue
+
+                    try:
+                        db.move_to_outbox(subscribers[task_id], '{}:{}'.format(task_id, task.state), response)
+                    except Exception as exc:
+                        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+
+
+def drain_outbox():
+    outbox = cfg.get('outbox', {})
+    try:
+        db = DB(cfg['db']['path'])
+        messages = db.list_outbox(outbox.get('batch_size', 30))
+    except Exception as exc:
+        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+        return
+
+    flood_wait = None
+    for id, uid, text, attempts in messages:
+        try:
+            updater.bot.sendMessage(
+                chat_id=uid,
+                text=text
+            )
+        except Exception as exc:
+            logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+            flood_wait = getattr(exc, 'retry_after', None)
+            try:
+                if flood_wait:
+                    # Flood limit applies to the whole bot, do not charge the message an attempt
+                    db.retry_outbox(id, flood_wait, attempt=False)
+                elif attempts + 1 >= outbox.get('max_attempts', 10):
+                    db.set_outbox_status(id, OUTBOX_FAILED)
+                else:
+                    db.retry_outbox(id, min(outbox.get('backoff', 10) * 2 ** attempts,
+                                            outbox.get('max_backoff', 3600)))
+            except Exception as exc:
+                logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+            if flood_wait:
+                break
+        else:
+            try:
+                db.set_outbox_status(id, OUTBOX_DELIVERED)
+            except Exception as exc:
+                logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+        time.sleep(1.0 / outbox.get('rate', 20))
+
+    try:
+        db.purge_outbox(outbox.get('retention', 86400))
+    except Exception as exc:
+        logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+    return flood_wait
 
 
 def has_live_threads(threads):
@@ -380,9 +761,76 @@ class checker_thread(Thread):
         self.kill_received = False
 
     def run(self):
+        checker = cfg.get('checker', {})
         while not self.kill_received:
-            check_subscriptions()
-            time.sleep(60)
+            check_rules()
+            if not checker.get('workers') and not checker.get('external'):
+                check_subscriptions()
+            time.sleep(checker.get('interval', 60))
+
+
+def checker_worker(config, index, debug=False):
+    global cfg
+    global vc
+    global logger
+    global tz
+
+    logger = init_log(debug=debug)
+    cfg = get_config(config)
+    tz = cfg.get('timezone', 'Europe/Moscow')
+    checker = cfg.get('checker', {})
+    interval = checker.get('interval', 60)
+    lease_ttl = checker.get('lease_ttl', 3 * interval)
+    shards = checker.get('shards') or checker.get('workers') or 1
+    owner = 'worker-{}-{}'.format(index, os.getpid())
+
+    logger.info('Starting subscriptions checker {}'.format(owner))
+    try:
+        vc = vCenter(cfg['vmware']['server'],
+                     cfg['vmware']['username'],
+                     cfg['vmware']['password'])
+    except Exception as exc:
+        logger.error('VMWare vCenter connection error: {}'.format(exc))
+        time.sleep(interval)
+        sys.exit(1)
+
+    try:
+        while True:
+            try:
+                db = DB(cfg['db']['path'])
+                owned = db.claim_shards(owner, index, shards, lease_ttl)
+            except Exception as exc:
+                logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+            else:
+                logger.debug('Checker {} owns shards {}'.format(owner, sorted(owned)))
+                if owned:
+                    check_subscriptions(owned, shards, lambda: db.renew_shards(owner, lease_ttl))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        try:
+            DB(cfg['db']['path']).release_shards(owner)
+        except Exception as exc:
+            logger.error('%s' % ('{}({})'.format(type(exc).__name__, exc)))
+
+
+def start_worker(config, index, debug=False):
+    worker = multiprocessing.get_context('spawn').Process(target=checker_worker,
+                                                          args=(config, index, debug),
+                                                          daemon=True)
+    worker.start()
+    return worker
+
+
+class drainer_thread(Thread):
+    def __init__(self):
+        Thread.__init__(self)
+        self.kill_received = False
+
+    def run(self):
+        interval = cfg.get('outbox', {}).get('interval', 5)
+        while not self.kill_received:
+            flood_wait = drain_outbox()
+            time.sleep(max(interval, flood_wait or 0))
 
 
 def main():
@@ -392,22 +840,30 @@ def main():
     global sender
     global updater
     global logger
+    global snapshots
+    global tz
 
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-c', '--config', required=True,
                            help='configuration file')
     argparser.add_argument('--debug', action='store_true')
+    argparser.add_argument('--worker', type=int, metavar='INDEX',
+                           help='run only a subscriptions checker worker with the given index')
     args = argparser.parse_args()
 
-    logger = init_log(debug=args.debug)
-
     if not path.isfile(args.config):
         print('VMware task notification bot configuration file {} not found'.format(args.config))
-        logger.error('VMware task notification bot configuration file {} not found'.format(args.config))
         sys.exit()
 
+    if args.worker is not None:
+        checker_worker(args.config, args.worker, args.debug)
+        sys.exit(0)
+
+    logger = init_log(debug=args.debug)
+
     logger.info('Starting vmware task notifier bot')
     cfg = get_config(args.config)
+    tz = cfg.get('timezone', 'Europe/Moscow')
     try:
         vc = vCenter(cfg['vmware']['server'],
                      cfg['vmware']['username'],
@@ -417,9 +873,15 @@ def main():
 
     try:
         db = DB(cfg['db']['path'])
+        reload_rules(db)
     except Exception as exc:
         logger.error('SQLite DB connection error: {}'.format(exc))
 
+    pagination = cfg.get('pagination', {})
+    snapshots = SnapshotCache(max_entries=pagination.get('cache_entries', 100),
+                              max_bytes=pagination.get('cache_bytes', 4 * 1024 * 1024),
+                              ttl=pagination.get('cache_ttl', 3600))
+
     if 'proxy' in cfg['telegram']:
         REQUEST_KWARGS = {
             'proxy_url': cfg['telegram']['proxy']['url'],
@@ -442,6 +904,11 @@ def main():
     unsubscribe_all_handler = CommandHandler('vmunsuball', unsubscribe_all_task, pass_args=False)
     unsubscribe_handler = CommandHandler('vmunsub', unsubscribe_task, pass_args=True)
     list_subscription_handler = CommandHandler('vmlistsub', list_subscription)
+    subscribe_rule_handler = CommandHandler('vmsubrule', subscribe_rule, pass_args=True)
+    unsubscribe_rule_handler = CommandHandler('vmunsubrule', unsubscribe_rule, pass_args=True)
+    list_rule_handler = CommandHandler('vmlistrule', list_rule)
+    export_handler = CommandHandler('vmexport', export_result, pass_args=True)
+    page_handler = CallbackQueryHandler(turn_page, pattern=r'^page:\d+$')
     unknown_handler = MessageHandler(Filters.command, unknown)
 
     dp.add_handler(start_handler)
@@ -453,21 +920,40 @@ def main():
     dp.add_handler(unsubscribe_all_handler)
     dp.add_handler(unsubscribe_handler)
     dp.add_handler(list_subscription_handler)
+    dp.add_handler(subscribe_rule_handler)
+    dp.add_handler(unsubscribe_rule_handler)
+    dp.add_handler(list_rule_handler)
+    dp.add_handler(export_handler)
+    dp.add_handler(page_handler)
     dp.add_handler(unknown_handler)
 
+    checker = cfg.get('checker', {})
+    workers = []
+    if not checker.get('external'):
+        workers = [start_worker(args.config, index, args.debug)
+                   for index in range(checker.get('workers', 0))]
+
     t1 = Thread(target=start_bot)
     t1.start()
 
     t2 = checker_thread()
     t2.start()
 
-    threads = [t1, t2]
+    t3 = drainer_thread()
+    t3.start()
+
+    threads = [t1, t2, t3]
 
     while has_live_threads(threads):
         try:
             [t.join(1) for t in threads if t is not None and t.is_alive()]
+            for index, worker in enumerate(workers):
+                if not worker.is_alive() and not t2.kill_received:
+                    logger.error('Subscriptions checker worker {} died with exit code {}, restarting'.format(index, worker.exitcode))
+                    workers[index] = start_worker(args.config, index, args.debug)
         except KeyboardInterrupt:
             t2.kill_received = True
+            t3.kill_received = True
             try:
                 updater.stop()
                 t1.join()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class SnapshotCache(object):
+    """Bounded LRU cache of paginated result snapshots.
+
+    Entries are keyed by (chat_id, message_id) and expire after `ttl` seconds.
+    Eviction is driven both by the number of entries and by the total size of
+    the cached pages in bytes.
+    """
+
+    def __init__(self, max_entries=100, max_bytes=4 * 1024 * 1024, ttl=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def sizeof(pages):
+        return sum(len(page.encode('utf-8')) for page in pages)
+
+    def fits(self, pages):
+        return self.sizeof(pages) <= self.max_bytes
+
+    def put(self, chat_id, message_id, pages):
+        """Cache pages, return False if they are larger than the whole cache."""
+        key = (chat_id, message_id)
+        size = self.sizeof(pages)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (pages, size, time.time() + self.ttl)
+            self.size += size
+            self._evict()
+        return True
+
+    def get(self, chat_id, message_id):
+        key = (chat_id, message_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[2] < now]:
+            self._remove(key)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
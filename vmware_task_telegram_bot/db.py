@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 import sqlite3
+import time
+
+
+OUTBOX_PENDING = 0
+OUTBOX_DELIVERED = 1
+OUTBOX_FAILED = 2
 
 
 class DBException(RuntimeError):
@@ -17,9 +23,15 @@ class DB(object):
             self.create_table()
 
     def create_table(self):
-        sql = 'CREATE TABLE IF NOT EXISTS subscription (uid VARCHAR, taskid VARCHAR)'
+        sql = ('CREATE TABLE IF NOT EXISTS subscription (uid VARCHAR, taskid VARCHAR);'
+               'CREATE TABLE IF NOT EXISTS rule (uid VARCHAR, field VARCHAR, pattern VARCHAR);'
+               'CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, dedup VARCHAR UNIQUE, '
+               'uid VARCHAR, text VARCHAR, attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0, '
+               'status INTEGER DEFAULT 0, created REAL);'
+               'CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt);'
+               'CREATE TABLE IF NOT EXISTS lease (shard INTEGER PRIMARY KEY, owner VARCHAR, expires REAL);')
         try:
-            self.cur.execute(sql)
+            self.cur.executescript(sql)
         except Exception as exc:
             self.cur.rollback()
             raise DBException(exc)
@@ -88,6 +100,185 @@ class DB(object):
             self.conn.commit()
             self.vacuum_db()
 
+    def add_rule(self, uid, field, pattern):
+        sql = 'INSERT INTO rule (uid, field, pattern) VALUES (?,?,?)'
+        try:
+            self.cur.execute(sql, (uid, field, pattern))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def list_rules(self):
+        sql = 'SELECT * FROM rule'
+        try:
+            data = self.cur.execute(sql).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            return data
+
+    def get_rule(self, uid, field, pattern):
+        sql = 'SELECT * FROM rule WHERE uid = ? AND field = ? AND pattern = ?'
+        try:
+            data = self.cur.execute(sql, (uid, field, pattern)).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            if data:
+                return True
+            else:
+                return False
+
+    def get_rule_by_uid(self, uid):
+        sql = 'SELECT * FROM rule WHERE uid = ?'
+        try:
+            data = self.cur.execute(sql, (uid,)).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            return data
+
+    def remove_rule(self, uid, field, pattern):
+        sql = 'DELETE FROM rule WHERE uid = ? AND field = ? AND pattern = ?'
+        try:
+            self.cur.execute(sql, (uid, field, pattern))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def remove_rule_by_uid(self, uid):
+        sql = 'DELETE FROM rule WHERE uid = ?'
+        try:
+            self.cur.execute(sql, (uid,))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def add_outbox(self, uid, dedup, text):
+        sql = 'INSERT OR IGNORE INTO outbox (dedup, uid, text, created) VALUES (?,?,?,?)'
+        try:
+            self.cur.execute(sql, (dedup, uid, text, time.time()))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def move_to_outbox(self, subscriptions, dedup, text):
+        """Atomically replace (uid, taskid) subscriptions with outbox messages."""
+        try:
+            with self.conn:
+                for uid, task_id in subscriptions:
+                    self.conn.execute('DELETE FROM subscription WHERE uid = ? AND taskid = ?', (uid, task_id))
+                    self.conn.execute('INSERT OR IGNORE INTO outbox (dedup, uid, text, created) VALUES (?,?,?,?)',
+                                      ('{}:{}'.format(uid, dedup), uid, text, time.time()))
+        except Exception as exc:
+            raise DBException(exc)
+
+    def list_outbox(self, limit):
+        sql = 'SELECT id, uid, text, attempts FROM outbox WHERE status = 0 AND next_attempt <= ? ORDER BY id LIMIT ?'
+        try:
+            data = self.cur.execute(sql, (time.time(), limit)).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            return data
+
+    def set_outbox_status(self, id, status):
+        sql = 'UPDATE outbox SET status = ? WHERE id = ?'
+        try:
+            self.cur.execute(sql, (status, id))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def retry_outbox(self, id, delay, attempt=True):
+        sql = 'UPDATE outbox SET attempts = attempts + ?, next_attempt = ? WHERE id = ?'
+        try:
+            self.cur.execute(sql, (1 if attempt else 0, time.time() + delay, id))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def purge_outbox(self, age):
+        sql = 'DELETE FROM outbox WHERE status != 0 AND created < ?'
+        try:
+            self.cur.execute(sql, (time.time() - age,))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
+    def claim_shards(self, owner, home, shards, ttl):
+        """Renew owned shard leases and claim a fair share of the free ones.
+
+        A worker always takes back its home shard and holds at most
+        ceil(shards / live workers) shards. Extra shards are released so
+        that newly started workers can claim them.
+        """
+        now = time.time()
+        try:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.execute('DELETE FROM lease WHERE shard >= ?', (shards,))
+                self.conn.executemany('INSERT OR IGNORE INTO lease (shard, owner, expires) VALUES (?, NULL, 0)',
+                                      [(shard,) for shard in range(shards)])
+                self.conn.execute('UPDATE lease SET expires = ? WHERE owner = ?', (now + ttl, owner))
+                if home < shards:
+                    self.conn.execute('UPDATE lease SET owner = ?, expires = ? WHERE shard = ?',
+                                      (owner, now + ttl, home))
+
+                others = self.conn.execute('SELECT COUNT(DISTINCT owner) FROM lease WHERE owner != ? AND expires >= ?',
+                                           (owner, now)).fetchone()[0]
+                limit = -(-shards // (others + 1))
+                owned = [row[0] for row in self.conn.execute('SELECT shard FROM lease WHERE owner = ? ORDER BY shard',
+                                                             (owner,))]
+                if len(owned) > limit:
+                    extra = [shard for shard in owned if shard != home][:len(owned) - limit]
+                    self.conn.executemany('UPDATE lease SET owner = NULL, expires = 0 WHERE shard = ?',
+                                          [(shard,) for shard in extra])
+                elif len(owned) < limit:
+                    free = self.conn.execute('SELECT shard FROM lease WHERE expires < ? ORDER BY shard LIMIT ?',
+                                             (now, limit - len(owned))).fetchall()
+                    self.conn.executemany('UPDATE lease SET owner = ?, expires = ? WHERE shard = ?',
+                                          [(owner, now + ttl, row[0]) for row in free])
+            data = self.cur.execute('SELECT shard FROM lease WHERE owner = ?', (owner,)).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            return set(row[0] for row in data)
+
+    def renew_shards(self, owner, ttl):
+        try:
+            with self.conn:
+                self.conn.execute('UPDATE lease SET expires = ? WHERE owner = ?', (time.time() + ttl, owner))
+            data = self.cur.execute('SELECT shard FROM lease WHERE owner = ?', (owner,)).fetchall()
+        except Exception as exc:
+            raise DBException(exc)
+        else:
+            return set(row[0] for row in data)
+
+    def release_shards(self, owner):
+        sql = 'UPDATE lease SET owner = NULL, expires = 0 WHERE owner = ?'
+        try:
+            self.cur.execute(sql, (owner,))
+        except Exception as exc:
+            self.conn.rollback()
+            raise DBException(exc)
+        else:
+            self.conn.commit()
+
     def vacuum_db(self):
         try:
             self.conn.execute('VACUUM')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import gzip
+import json
+from fnmatch import fnmatchcase
+from tempfile import SpooledTemporaryFile
+from vmware_task_telegram_bot.model import get_timezone
+
+
+TASK_FILTERS = {'entity': 'entityName',
+                'user': 'username',
+                'type': 'descriptionId',
+                'state': 'state'}
+
+ALARM_FILTERS = {'entity': 'entityName',
+                 'status': 'status',
+                 'description': 'description'}
+
+FILTER_FIELDS = {'tasks': TASK_FILTERS,
+                 'history': TASK_FILTERS,
+                 'alarms': ALARM_FILTERS}
+
+
+class ExportException(RuntimeError):
+    """An export error occured."""
+
+
+class ExportTooLarge(ExportException):
+    """The export exceeded the upload size limit."""
+
+
+class Encoder(object):
+    """Minimal text stream that encodes writes into a binary file.
+
+    Raises ExportTooLarge as soon as more than `limit` bytes were written
+    to `spool`, the file that is finally uploaded.
+    """
+
+    def __init__(self, stream, spool=None, limit=None):
+        self.stream = stream
+        self.spool = spool if spool is not None else stream
+        self.limit = limit
+
+    def write(self, text):
+        self.stream.write(text.encode('utf-8'))
+        if self.limit and self.spool.tell() > self.limit:
+            raise ExportTooLarge('Export exceeds {} bytes'.format(self.limit))
+
+
+def parse_filters(kind, args):
+    fields = FILTER_FIELDS[kind]
+    filters = {}
+    for arg in args:
+        key, _, pattern = arg.partition('=')
+        if key not in fields or not pattern:
+            raise ExportException('Unsupported filter {} for {}'.format(arg, kind))
+        filters[fields[key]] = pattern
+    return filters
+
+
+def apply_filters(items, filters):
+    for item in items:
+        if all(fnmatchcase(str(getattr(item, field, '')), pattern) for field, pattern in filters.items()):
+            yield item
+
+
+def format_value(value, tz):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.astimezone(get_timezone(tz)).isoformat()
+    if isinstance(value, (int, float)):
+        return value
+    return str(getattr(value, 'msg', None) or value)
+
+
+def write_csv(items, fields, stream, tz):
+    count = 0
+    writer = csv.writer(stream)
+    writer.writerow(fields)
+    for item in items:
+        writer.writerow([format_value(getattr(item, field), tz) for field in fields])
+        count += 1
+    return count
+
+
+def write_json(items, fields, stream, tz):
+    count = 0
+    stream.write('[')
+    for item in items:
+        if count:
+            stream.write(',')
+        stream.write('\n')
+        stream.write(json.dumps(dict((field, format_value(getattr(item, field), tz)) for field in fields),
+                                ensure_ascii=False))
+        count += 1
+    stream.write('\n]\n')
+    return count
+
+
+def export(items, fields, fmt='csv', compress=False, tz='Europe/Moscow', max_size=1024 * 1024, limit=None):
+    """Stream items into a spooled temporary file.
+
+    Returns the file rewound to the beginning and the number of exported rows.
+    Only `max_size` bytes are kept in memory, the rest is spooled to disk.
+    Writing stops with ExportTooLarge once the file grows beyond `limit` bytes.
+    """
+    writers = {'csv': write_csv, 'json': write_json}
+    if fmt not in writers:
+        raise ExportException('Unsupported format {}'.format(fmt))
+
+    spool = SpooledTemporaryFile(max_size=max_size)
+    try:
+        if compress:
+            with gzip.GzipFile(fileobj=spool, mode='wb') as archive:
+                count = writers[fmt](items, fields, Encoder(archive, spool, limit), tz)
+        else:
+            count = writers[fmt](items, fields, Encoder(spool, spool, limit), tz)
+        if limit and spool.tell() > limit:
+            raise ExportTooLarge('Export exceeds {} bytes'.format(limit))
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, count
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import emoji
+from functools import lru_cache
+from pytz import timezone
+
+
+TASK_TEMPLATES = {
+    'running': u'ID: {eventChainId}\r\nОписание: {descriptionId}\r\nОбъект: {entityName}\r\nПользователь: {username}\r\nСтатус: {state}\r\nПроцент выполнения: {progress}\r\nНачало работы: {startTime}\r\n',
+    'subscription': u'ID: {eventChainId}\r\nОписание: {descriptionId}\r\nОбъект: {entityName}\r\nПользователь: {username}\r\nСтатус: {state}\r\nПрогресс выполнения: {progress} %\r\nНачало работы: {startTime}\r\n',
+    'success': u'Задача успешно завершена\r\nID: {eventChainId}\r\nОписание: {descriptionId}\r\nОбъект: {entityName}\r\nПользователь: {username}\r\nСтатус: {state}\r\nНачало работы: {startTime}\r\nОкончание работы: {completeTime}',
+    'error': u'Задача завершена с ошибкой\r\nID: {eventChainId}\r\nОписание: {descriptionId}\r\nОбъект: {entityName}\r\nПользователь: {username}\r\nСтатус: {state}\r\nОписание ошибки: {error}\r\nНачало работы: {startTime}\r\nОкончание работы: {completeTime}',
+}
+
+ALARM_TEMPLATE = u'Описание: {description}\r\nОбъект: {entityName}\r\nВажность: {status}\r\nВремя: {time}\r\n'
+
+ALARM_STATUS_EMOJI = {'gray': emoji.emojize(':gray_circle:'),
+                      'green': emoji.emojize(':green_circle:'),
+                      'yellow': emoji.emojize(':yellow_circle:'),
+                      'red': emoji.emojize(':red_circle:')}
+
+
+class Snapshot(object):
+    """Immutable value object.
+
+    `fingerprint` is a cheap tuple for change detection between checker
+    cycles. Equality compares every field, the hash uses the fingerprint.
+    """
+
+    __slots__ = ('fingerprint',)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name)
+                                                 for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def task_reason(reason):
+    """Return the user name of a TaskReasonUser or a label for other reasons."""
+    if getattr(reason, 'userName', None):
+        return reason.userName
+    if getattr(reason, 'alarmName', None):
+        return u'alarm:{}'.format(reason.alarmName)
+    if getattr(reason, 'name', None):
+        return u'schedule:{}'.format(reason.name)
+    return u'system'
+
+
+class TaskSnapshot(Snapshot):
+    __slots__ = ('eventChainId', 'entityName', 'descriptionId', 'username',
+                 'state', 'progress', 'error', 'startTime', 'completeTime', 'key', 'queueTime')
+
+    def __init__(self, eventChainId, entityName, descriptionId, username,
+                 state, progress=None, error=None, startTime=None, completeTime=None,
+                 key=None, queueTime=None):
+        for name, value in (('eventChainId', eventChainId),
+                            ('entityName', entityName),
+                            ('descriptionId', descriptionId),
+                            ('username', username),
+                            ('state', state),
+                            ('progress', progress),
+                            ('error', error),
+                            ('startTime', startTime),
+                            ('completeTime', completeTime),
+                            ('key', key),
+                            ('queueTime', queueTime),
+                            ('fingerprint', (eventChainId, state, progress))):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_task_info(cls, task_info):
+        return cls(eventChainId=task_info.eventChainId,
+                   entityName=task_info.entityName,
+                   descriptionId=task_info.descriptionId,
+                   username=task_reason(task_info.reason),
+                   state=task_info.state,
+                   progress=task_info.progress,
+                   error=task_info.error,
+                   startTime=task_info.startTime,
+                   completeTime=task_info.completeTime,
+                   key=task_info.key,
+                   queueTime=task_info.queueTime)
+
+
+class AlarmSnapshot(Snapshot):
+    __slots__ = ('key', 'entityName', 'description', 'status', 'time')
+
+    def __init__(self, key, entityName, description, status, time):
+        for name, value in (('key', key),
+                            ('entityName', entityName),
+                            ('description', description),
+                            ('status', status),
+                            ('time', time),
+                            ('fingerprint', (key, status, time))):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_alarm_state(cls, alarm):
+        return cls(key=alarm.key,
+                   entityName=alarm.entity.name,
+                   description=alarm.alarm.info.name,
+                   status=alarm.overallStatus,
+                   time=alarm.time)
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return timezone(name)
+
+
+def format_time(value, tz):
+    if value is None:
+        return ''
+    return value.astimezone(get_timezone(tz)).strftime('%Y-%m-%d %H:%M')
+
+
+def error_message(error):
+    if error is None:
+        return None
+    return str(getattr(error, 'msg', None) or error)
+
+
+def render_task(task, template, tz):
+    return _render_task(template, tz, task.eventChainId, task.descriptionId, task.entityName, task.username,
+                        task.state, task.progress, error_message(task.error), task.startTime, task.completeTime)
+
+
+@lru_cache(maxsize=1024)
+def _render_task(template, tz, eventChainId, descriptionId, entityName, username,
+                 state, progress, error, startTime, completeTime):
+    return TASK_TEMPLATES[template].format(eventChainId=eventChainId,
+                                           descriptionId=descriptionId,
+                                           entityName=entityName,
+                                           username=username,
+                                           state=state,
+                                           progress=progress,
+                                           error=error,
+                                           startTime=format_time(startTime, tz),
+                                           completeTime=format_time(completeTime, tz))
+
+
+def render_alarm(alarm, tz):
+    return _render_alarm(tz, alarm.description, alarm.entityName, alarm.status, alarm.time)
+
+
+@lru_cache(maxsize=1024)
+def _render_alarm(tz, description, entityName, status, time):
+    return ALARM_TEMPLATE.format(description=description,
+                                 entityName=entityName,
+                                 status=ALARM_STATUS_EMOJI[status],
+                                 time=format_time(time, tz))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+
+class RuleIndex(object):
+    """Compiled index of subscription rules.
+
+    Entity rules ending with `*` are stored in a prefix trie on the entity name,
+    all other rules are stored in per-field hashes. Matching a task costs
+    O(len(entityName)) regardless of the number of rules.
+    """
+
+    FIELDS = {'entity': 'entityName',
+              'user': 'username',
+              'type': 'descriptionId'}
+
+    def __init__(self, rules=()):
+        self.trie = {}
+        self.exact = dict((field, {}) for field in self.FIELDS)
+        for uid, field, pattern in rules:
+            self.add(uid, field, pattern)
+
+    @classmethod
+    def validate(cls, field, pattern):
+        if field not in cls.FIELDS or not pattern:
+            return False
+        if field == 'entity':
+            return '*' not in pattern[:-1]
+        return '*' not in pattern
+
+    def add(self, uid, field, pattern):
+        if field == 'entity' and pattern.endswith('*'):
+            node = self.trie
+            for char in pattern[:-1]:
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(uid)
+        else:
+            self.exact[field].setdefault(pattern, set()).add(uid)
+
+    def match(self, task):
+        result = set()
+        for field, key in self.FIELDS.items():
+            result.update(self.exact[field].get(getattr(task, key), ()))
+
+        node = self.trie
+        for char in task.entityName or '':
+            result.update(node.get(None, ()))
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            result.update(node.get(None, ()))
+        return result
@@ -2,8 +2,13 @@
 from pyVmomi import vim
 from pyVim import connect
 import atexit
+import logging
 import requests
 import ssl
+from vmware_task_telegram_bot.model import AlarmSnapshot, TaskSnapshot
+
+
+logger = logging.getLogger('cit-telegram-bot')
 
 
 class vCenterException(RuntimeError):
@@ -39,50 +44,12 @@ class vCenter(object):
             vCenterException("Unable to connect to host with supplied info.")
 
     def format_task(self, task_info):
-        if task_info.state == 'success':
-            result = {'entityName': task_info.entityName,
-                      'descriptionId': task_info.descriptionId,
-                      'state': task_info.state,
-                      'startTime': task_info.startTime,
-                      'completeTime': task_info.completeTime,
-                      'eventChainId': task_info.task.info.eventChainId,
-                      'username': task_info.reason.userName}
-
-        elif task_info.state == 'running':
-            result = {'entityName': task_info.task.info.entityName,
-                      'descriptionId': task_info.task.info.descriptionId,
-                      'state': task_info.task.info.state,
-                      'progress': task_info.task.info.progress,
-                      'startTime': task_info.task.info.startTime,
-                      'eventChainId': task_info.task.info.eventChainId,
-                      'username': task_info.task.info.reason.userName}
-
-        elif task_info.state == 'queued':
-            result = {'entityName': task_info.task.info.entityName,
-                      'descriptionId': task_info.task.info.descriptionId,
-                      'state': task_info.task.info.state,
-                      'progress': task_info.task.info.progress,
-                      'startTime': task_info.task.info.startTime,
-                      'eventChainId': task_info.task.info.eventChainId,
-                      'username': task_info.task.info.reason.userName}
-
-        elif task_info.state == 'error':
-            result = {'entityName': task_info.entityName,
-                      'descriptionId': task_info.descriptionId,
-                      'state': task_info.state,
-                      'error': task_info.error,
-                      'startTime': task_info.startTime,
-                      'completeTime': task_info.completeTime,
-                      'username': task_info.reason.userName}
-
-        return result
+        if task_info.state in ('running', 'queued'):
+            task_info = task_info.task.info
+        return TaskSnapshot.from_task_info(task_info)
 
     def format_alarm(self, alarm):
-        result = {'entityName': alarm.entity.name,
-                  'description': alarm.alarm.info.name,
-                  'status': alarm.overallStatus,
-                  'time': alarm.time}
-        return result
+        return AlarmSnapshot.from_alarm_state(alarm)
 
     def list_active_alarm(self):
         result = []
@@ -99,6 +66,62 @@ class vCenter(object):
                     raise vCenterException(exc)
         return result
 
+    def iter_alarm(self):
+        try:
+            alarms = self.SI.RetrieveContent().rootFolder.triggeredAlarmState
+        except Exception as exc:
+            raise vCenterException(exc)
+        for alarm in alarms:
+            try:
+                item = self.format_alarm(alarm)
+            except Exception as exc:
+                logger.error('Unable to format alarm {}: {}'.format(getattr(alarm, 'key', None), exc))
+                continue
+            yield item
+
+    def current_time(self):
+        try:
+            return self.SI.CurrentTime()
+        except Exception as exc:
+            raise vCenterException(exc)
+
+    def iter_task(self, state=None, begin_time=None, page_size=100, time_type='startedTime', ids=None):
+        taskManager = self.SI.content.taskManager
+        spec = vim.TaskFilterSpec()
+        if ids is not None:
+            if not ids:
+                return
+            spec.eventChainId = [int(id) for id in ids]
+        if state:
+            spec.state = state
+        if begin_time:
+            spec.time = vim.TaskFilterSpec.ByTime(timeType=time_type, beginTime=begin_time)
+        try:
+            tasks = taskManager.CreateCollectorForTasks(spec)
+        except Exception as exc:
+            raise vCenterException(exc)
+        try:
+            try:
+                tasks.RewindCollector()
+            except Exception as exc:
+                raise vCenterException(exc)
+            while True:
+                try:
+                    page = tasks.ReadNextTasks(page_size)
+                except Exception as exc:
+                    raise vCenterException(exc)
+                if not page:
+                    break
+                for task_item in page:
+                    try:
+                        item = self.format_task(task_item)
+                    except Exception as exc:
+                        logger.error('Unable to format task {}: {}'.format(getattr(task_item, 'key', None), exc))
+                        continue
+                    yield item
+        finally:
+            tasks.DestroyCollector()
+
     def list_running_task(self):
         result = []
         taskManager = self.SI.content.taskManager
@@ -145,7 +168,7 @@ class vCenter(object):
         else:
             try:
                 for task_item in alltasks:
-                    if task_item['state'] == 'running':
+                    if task_item.state == 'running':
                         return True
             except Exception as exc:
                 raise vCenterException(exc)